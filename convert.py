@@ -10,10 +10,18 @@
 - 更健壮的正则，支持更宽松的域名/keyword 捕获（包括点和 Unicode）
 - 去除重复，保留注释行并在输出中标注未识别规则
 - 更友好的错误处理与统计信息
+- 复用单个 requests.Session（连接池 + keep-alive），多个规则源并发拉取
+- 基于 ETag / Last-Modified 的条件请求，上游未变更时复用本地缓存
 """
-from typing import List, Set
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Set, Tuple, cast
 import re
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import sys
 import os
 
@@ -22,10 +30,27 @@ URL_CONFIG_FILE = "rules.txt"
 ADGUARD_OUTPUT_FILE = "adguard-rules.txt"
 WHITE_LIST_FILE = "white.txt"  # 白名单文件
 USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36"
-REQUEST_TIMEOUT = 30
+REQUEST_TIMEOUT = (5, 30)  # (连接超时, 读取超时) 秒
+FETCH_WORKERS = 16  # 并发拉取线程数（网络 I/O 会释放 GIL）
+# 条件请求缓存目录（ETag / Last-Modified），可用环境变量 ADGUARD_REJECT_CACHE 覆盖
+CACHE_DIR = os.environ.get("ADGUARD_REJECT_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "adguard-reject"))
 
-# 通用用于捕获域名 / 关键词的模式：尽量宽松，捕获非逗号非空白串（包括带点的域名或关键词）
-TOKEN_RE = r'([^\s,]+)'
+# url 规则需要拆出域名与路径，仍用预编译正则；其余规则为固定的 "类型, 值, reject" 三段，直接按逗号切分
+_URL_RE = re.compile(r'url\s*,\s*(?:(?:https?|wss?)://)?([^\s/,]+)(/[^\s,]*)?\s*,\s*reject\s*$', re.I)
+_HOST_KINDS = frozenset(('host', 'host-suffix', 'host-keyword'))
+_RULE_PREFIXES = ('host', 'url')
+_REJECT_RE = re.compile(r'reject', re.I)
+
+# 白名单解析正则：AdGuard 白名单格式（@@||xxx^）与纯域名
+_ADG_WHITE_RE = re.compile(r'^@@\|\|(?:https?://)?([^|^$]+)')
+_DOMAIN_RE = re.compile(r'^([a-zA-Z0-9][a-zA-Z0-9.-]+[a-zA-Z0-9])$')
+
+
+def _iter_clean_lines(lines: Iterable[str]) -> Iterator[str]:
+    """单次遍历产出已去除首尾空白的非空、非 # 注释行（不构造中间列表）"""
+    for s in map(str.strip, lines):
+        if s and s[0] != '#':
+            yield s
 
 
 def read_rule_urls(config_file: str) -> List[str]:
@@ -34,16 +59,12 @@ def read_rule_urls(config_file: str) -> List[str]:
         print(f"❌ 错误：未找到配置文件 {config_file}")
         sys.exit(1)
 
-    with open(config_file, 'r', encoding='utf-8') as f:
-        lines = [line.rstrip('\n') for line in f]
-
     urls = []
     seen = set()
-    for line in lines:
-        s = line.strip()
-        if not s or s.startswith('#'):
-            continue
-        if s not in seen:
+    with open(config_file, 'r', encoding='utf-8') as f:
+        for s in _iter_clean_lines(f):
+            if s in seen:
+                continue
             seen.add(s)
             urls.append(s)
 
@@ -59,15 +80,11 @@ def read_rule_urls(config_file: str) -> List[str]:
 
 def load_white_list() -> Set[str]:
     """加载白名单域名，支持 AdGuard 白名单格式（@@||xxx^）和纯域名，返回小写域名集合"""
-    white_list = set()
+    white_list: Set[str] = set()
     if not os.path.exists(WHITE_LIST_FILE):
         print(f"ℹ️  未找到白名单文件 {WHITE_LIST_FILE}，将不进行排除操作")
         return white_list
 
-    # 修复正则表达式：将 |? 改为 (?: 正确表示非捕获组
-    adguard_white_pattern = re.compile(r'^@@\|\|(?:https?://)?([^|^$]+)')
-    domain_pattern = re.compile(r'^([a-zA-Z0-9][a-zA-Z0-9.-]+[a-zA-Z0-9])$')
-
     try:
         with open(WHITE_LIST_FILE, 'r', encoding='utf-8') as f:
             for line_num, line in enumerate(f, 1):
@@ -76,7 +93,7 @@ def load_white_list() -> Set[str]:
                     continue  # 跳过注释和空行
 
                 # 处理 AdGuard 白名单格式（@@开头）
-                adguard_match = adguard_white_pattern.match(line)
+                adguard_match = _ADG_WHITE_RE.match(line)
                 if adguard_match:
                     domain = adguard_match.group(1).strip('.').lower()
                     if domain:
@@ -84,7 +101,7 @@ def load_white_list() -> Set[str]:
                         continue
 
                 # 处理纯域名格式
-                domain_match = domain_pattern.match(line)
+                domain_match = _DOMAIN_RE.match(line)
                 if domain_match:
                     domain = domain_match.group(1).strip('.').lower()
                     white_list.add(domain)
@@ -108,33 +125,113 @@ def is_whitelisted(rule: str, white_list: Set[str]) -> bool:
     # 提取规则中的域名部分
     domain = None
     if rule.startswith('0.0.0.0 '):
-        domain = rule.split()[1].lower()
+        domain = rule[8:].lower()
     elif rule.startswith('||') and rule.endswith('^'):
-        domain = rule[2:-1].split('/')[0].lower()  # 去掉||和^，并忽略路径部分
+        domain = rule[2:-1].partition('/')[0].lower()  # 去掉||和^，并忽略路径部分
 
     if not domain:
         return False
 
-    # 检查是否匹配白名单（支持子域名）
-    return any(domain == wl or domain.endswith(f'.{wl}') for wl in white_list)
+    # 检查是否匹配白名单（支持子域名）：逐级剥离左侧标签并查集合，O(标签数) 而非 O(白名单大小)
+    while True:
+        if domain in white_list:
+            return True
+        dot = domain.find('.')
+        if dot < 0:
+            return False
+        domain = domain[dot + 1:]
+
+
+def create_session() -> requests.Session:
+    """创建带连接池与重试的 Session，供所有规则源共享（复用 TCP/TLS 连接）"""
+    session = requests.Session()
+    session.headers.update({"User-Agent": USER_AGENT})
+    # 规则源多集中在少数主机（如 raw.githubusercontent.com），放大单主机连接池避免连接被丢弃重建
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=64,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504]),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _log(msg: str) -> None:
+    """单次 write 输出一行日志，避免并发拉取时多个线程的输出交错在同一行"""
+    sys.stdout.write(msg + "\n")
+
+
+def _cache_paths(url: str) -> Tuple[str, str]:
+    """返回某个规则源在缓存目录中的 (元数据 json, 已解码规则 txt) 路径"""
+    base = os.path.join(CACHE_DIR, hashlib.sha1(url.encode('utf-8')).hexdigest())
+    return f"{base}.json", f"{base}.txt"
+
+
+def _load_cache_meta(meta_path: str, body_path: str) -> Dict[str, str]:
+    """读取缓存元数据（etag / last_modified）；缓存不完整或损坏时返回空字典"""
+    if not os.path.exists(body_path):
+        return {}
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        return meta if isinstance(meta, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(meta_path: str, body_path: str, headers: Mapping[str, str], lines: List[str]) -> None:
+    """响应带 ETag / Last-Modified 时缓存已解码规则，供下次条件请求命中 304 时复用"""
+    meta = {
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+    }
+    if not meta['etag'] and not meta['last_modified']:
+        return
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        write_atomic(body_path, lines)
+        write_atomic(meta_path, [json.dumps(meta)])
+    except OSError as e:
+        _log(f"⚠️  写入缓存失败：{body_path} -> {e}")
+
 
+def fetch_single_url_rules(session: requests.Session, url: str) -> List[str]:
+    """拉取单个 URL 的规则文本并按行返回（过滤空行）；上游未变更（304）时复用本地缓存"""
+    meta_path, body_path = _cache_paths(url)
+    meta = _load_cache_meta(meta_path, body_path)
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
 
-def fetch_single_url_rules(url: str) -> List[str]:
-    """拉取单个 URL 的规则文本并按行返回（过滤空行）"""
     try:
-        print(f"\n📥 正在拉取：{url}")
-        r = requests.get(url, timeout=REQUEST_TIMEOUT, headers={"User-Agent": USER_AGENT}, allow_redirects=True)
-        r.raise_for_status()
-        text = r.content.decode('utf-8-sig', errors='ignore')
-        lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
-        print(f"✅ 拉取成功：{len(lines)} 行有效规则")
+        _log(f"\n📥 正在拉取：{url}")
+        # 流式读取并逐行解码，避免整份响应体在 bytes / str / list 间多次拷贝
+        with session.get(url, timeout=REQUEST_TIMEOUT, allow_redirects=True, stream=True, headers=headers) as r:
+            if r.status_code == 304 and headers:
+                with open(body_path, 'r', encoding='utf-8') as f:
+                    lines = [ln for ln in f.read().split('\n') if ln]
+                _log(f"✅ 未变更，使用缓存：{url}（{len(lines)} 行有效规则）")
+                return lines
+            r.raise_for_status()
+            r.encoding = 'utf-8-sig'
+            # 已设置 r.encoding，decode_unicode=True 时 iter_lines 只产出 str
+            decoded = cast(Iterator[str], r.iter_lines(chunk_size=1 << 16, decode_unicode=True))
+            lines = [ln for ln in map(str.strip, decoded) if ln]
+        _log(f"✅ 拉取成功：{url}（{len(lines)} 行有效规则）")
+        _save_cache(meta_path, body_path, r.headers, lines)
         return lines
     except requests.exceptions.RequestException as e:
-        print(f"⚠️  拉取失败：{url} -> {e}")
+        _log(f"⚠️  拉取失败：{url} -> {e}")
+        return []
+    except OSError as e:
+        _log(f"⚠️  读取缓存失败：{body_path} -> {e}")
         return []
 
 
-def convert_rule_line(line: str):
+def convert_rule_line(line: str) -> Optional[str]:
     """
     将单行 QuantumultX 规则转换为目标规则。
     返回一个字符串（转换后的规则）或 None（未识别或不需要转换）。
@@ -147,40 +244,78 @@ def convert_rule_line(line: str):
     """
     s = line.strip()
 
-    # host,domain,reject  -> hosts
-    m = re.match(rf'host\s*,\s*{TOKEN_RE}\s*,\s*reject\s*$', s, re.I)
-    if m:
-        domain = m.group(1)
-        # 避免把通配符等奇怪字符串写入 hosts
-        if domain in ('*', ''):
+    # 先做字面前缀判断（四种规则均以 host / url 开头），绝大多数无关行无需进入正则
+    if not s[:4].lower().startswith(_RULE_PREFIXES):
+        return None
+
+    parts = s.split(',')
+    if len(parts) != 3 or parts[2].strip().lower() != 'reject':
+        # 其他 reject 形式：暂不处理
+        return None
+
+    kind = parts[0].strip().lower()
+    if kind == 'url':
+        # url,protocol://domain/... , reject  -> ||domain/path^  （保留路径）
+        m = _URL_RE.match(s)
+        if not m:
             return None
-        return f"0.0.0.0 {domain}"
+        return f"||{m.group(1)}{m.group(2) or ''}^"
 
-    # host-suffix,domain, reject -> ||domain^
-    m = re.match(rf'host-suffix\s*,\s*{TOKEN_RE}\s*,\s*reject\s*$', s, re.I)
-    if m:
-        suffix = m.group(1)
-        return f"||{suffix}^"
+    if kind not in _HOST_KINDS:
+        return None
 
-    # host-keyword,keyword, reject -> ||keyword^
-    m = re.match(rf'host-keyword\s*,\s*{TOKEN_RE}\s*,\s*reject\s*$', s, re.I)
-    if m:
-        keyword = m.group(1)
-        return f"||{keyword}^"
+    # 值尽量宽松：接受任意非空白串（包括带点的域名、关键词和 Unicode）
+    token = parts[1].strip()
+    if len(token.split()) != 1:
+        return None
 
-    # url,protocol://domain/... , reject  -> ||domain/path^  （保留路径）
-    m = re.match(rf'url\s*,\s*(?:((?:https?|wss?)://)?)([^\s\/,]+)(/[^\s,]*)?\s*,\s*reject\s*$', s, re.I)
-    if m:
-        domain = m.group(2)
-        path = m.group(3) or ""
-        return f"||{domain}{path}^"
+    if kind == 'host':
+        # host,domain,reject  -> hosts
+        # 避免把通配符等奇怪字符串写入 hosts
+        if token == '*':
+            return None
+        return f"0.0.0.0 {token}"
 
-    # 其他 reject 形式：暂不处理
-    return None
+    # host-suffix,domain, reject / host-keyword,keyword, reject -> ||token^
+    return f"||{token}^"
 
 
-def merge_and_convert(all_rules: List[str], output_file: str, white_list: Set[str]) -> None:
-    """合并所有规则并转换写入输出文件，应用白名单过滤"""
+def write_atomic(path: str, lines: Iterable[str]) -> None:
+    """
+    逐行流式写入临时文件并 fsync 后 os.replace 覆盖目标文件。
+    不在内存中拼接整份输出；中途失败时原文件保持不变。
+    """
+    tmp = f"{path}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        with os.fdopen(fd, 'wb', buffering=1 << 20) as f:
+            write = f.write
+            for line in lines:
+                write(line.encode('utf-8'))
+                write(b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def merge_and_convert(
+    all_rules: List[str],
+    output_file: str,
+    white_list: Set[str],
+    verbose_skips: bool = False,
+    raw_count: Optional[int] = None,
+) -> None:
+    """
+    合并所有规则并转换写入输出文件，应用白名单过滤；verbose_skips 为 True 时才把非 reject 行写为注释。
+    all_rules 应为已去除首尾空白的行（fetch_single_url_rules 拉取时已处理）。
+    raw_count 为去重前拉取到的总行数（用于统计输出），缺省时取 len(all_rules)。
+    """
     header = [
         "# ===============================",
         "# 自动拉取+合并+转换自 QuantumultX 在线规则",
@@ -191,52 +326,55 @@ def merge_and_convert(all_rules: List[str], output_file: str, white_list: Set[st
         "#  - host-suffix, 域名后缀, reject -> AdGuard: ||域名^",
         "#  - host-keyword, 关键词, reject -> AdGuard: ||关键词^",
         "#  - url, 协议://域名/路径, reject -> AdGuard: ||域名/路径^",
-        "# 注：保留原注释行；未识别的规则会以注释形式写出以便人工检查",
+        "# 注：保留原注释行；未识别的规则会以注释形式写出以便人工检查（非 reject 规则默认不写出）",
         "# ===============================\n"
     ]
 
-    out_lines = []
-    out_lines.extend(header)
-    converted = set()
+    out_lines = list(header)
+    out_append = out_lines.append  # 热循环内绑定为局部名，省去每次属性查找
+    converted: Set[str] = set()
+    converted_add = converted.add
     converted_count = 0
     unrecognized_count = 0
     whitelisted_count = 0
-    raw_count = len(all_rules)
+    skipped_count = 0
+    if raw_count is None:
+        raw_count = len(all_rules)
 
     for line in all_rules:
         if not line:
             continue
-        stripped = line.strip()
 
         # 保留注释行原样（但不计入去重）
-        if stripped.startswith('#'):
-            out_lines.append(stripped)
-            continue
-
-        if 'reject' not in stripped.lower():
-            out_lines.append(f"# 跳过非 reject 规则：{stripped}")
+        if line[0] == '#':
+            out_append(line)
             continue
 
-        converted_rule = convert_rule_line(stripped)
+        # 可转换的规则必然以 reject 结尾，先直接转换；仅对未命中的行再区分是否为 reject 规则
+        converted_rule = convert_rule_line(line)
         if converted_rule:
             # 检查白名单
             if is_whitelisted(converted_rule, white_list):
                 whitelisted_count += 1
-                out_lines.append(f"# 已过滤白名单规则：{converted_rule}")
+                out_append(f"# 已过滤白名单规则：{converted_rule}")
                 continue
                 
-            if converted_rule not in converted:
-                out_lines.append(converted_rule)
-                converted.add(converted_rule)
-                converted_count += 1
+            if converted_rule in converted:
+                continue
+            converted_add(converted_rule)
+            out_append(converted_rule)
+            converted_count += 1
+        elif not _REJECT_RE.search(line):
+            skipped_count += 1
+            if verbose_skips:
+                out_append(f"# 跳过非 reject 规则：{line}")
         else:
-            out_lines.append(f"# 未识别规则：{stripped}")
+            out_append(f"# 未识别规则：{line}")
             unrecognized_count += 1
 
     # 写入文件
     try:
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write("\n".join(out_lines))
+        write_atomic(output_file, out_lines)
     except OSError as e:
         print(f"❌ 写入文件失败：{output_file} -> {e}")
         sys.exit(1)
@@ -247,25 +385,51 @@ def merge_and_convert(all_rules: List[str], output_file: str, white_list: Set[st
     print(f"  - 成功转换（去重后）规则数：{converted_count}")
     print(f"  - 白名单过滤规则数：{whitelisted_count}")
     print(f"  - 未识别规则数（已写为注释）：{unrecognized_count}")
+    print(f"  - 跳过非 reject 规则数：{skipped_count}")
     print(f"  - 输出文件：{output_file}")
 
 
-def main():
+def main() -> None:
+    parser = argparse.ArgumentParser(description="拉取 QuantumultX 在线规则并转换为 AdGuard / hosts 规则")
+    parser.add_argument("--verbose-skips", action="store_true", help="将非 reject 规则以注释形式写入输出文件（默认直接丢弃）")
+    args = parser.parse_args()
+
     urls = read_rule_urls(URL_CONFIG_FILE)
     white_list = load_white_list()  # 加载白名单
     
+    # 并发拉取，结果按 rules.txt 中的顺序合并
+    with create_session() as session, ThreadPoolExecutor(max_workers=FETCH_WORKERS) as ex:
+        results = list(ex.map(lambda u: fetch_single_url_rules(session, u), urls))
+
+    # 合并时即对规则行去重（多个规则源常有大量重叠），注释行原样保留
     all_rules: List[str] = []
-    for url in urls:
-        lines = fetch_single_url_rules(url)
+    seen_raw: Set[str] = set()
+    duplicate_count = 0
+    for lines in results:
         if lines:
-            all_rules.extend(lines)
+            for ln in lines:
+                if ln[0] != '#':
+                    if ln in seen_raw:
+                        duplicate_count += 1
+                        continue
+                    seen_raw.add(ln)
+                all_rules.append(ln)
             print(f"  → 当前累计规则行数：{len(all_rules)}")
 
+    if duplicate_count:
+        print(f"♻️  已跳过重复规则行：{duplicate_count} 行")
+
     if not all_rules:
         print("❌ 错误：未拉取到任何规则，退出。")
         sys.exit(1)
 
-    merge_and_convert(all_rules, ADGUARD_OUTPUT_FILE, white_list)
+    merge_and_convert(
+        all_rules,
+        ADGUARD_OUTPUT_FILE,
+        white_list,
+        verbose_skips=args.verbose_skips,
+        raw_count=len(all_rules) + duplicate_count,
+    )
 
 
 if __name__ == "__main__":